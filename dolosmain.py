@@ -1,41 +1,77 @@
 import os
+import csv
 import time
 import json
-import shutil
+import heapq
+import pickle
+import zipfile
+import tempfile
+import subprocess
+from operator import itemgetter
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 
 ZIP_DIR = "zipped"
-PLAIN_DIR = "raw_files"
 TEST_FILE = "human_eval_pile.jsonl"
 PROCESS_NUM = 16
+TOP_K = 500  # number of programs kept per problem
 
-# itereate through folders in the zip folder
-def call_dolos(folder_name):
-    print("working on folder: ", folder_name)
+def unique_programs(result):
+    # the same program is often found more than once, every distinct program is mapped to the numbers of its results
+    programs = {}
+    for j, temp_result in enumerate(result['top_k'][:TOP_K]):
+        programs.setdefault(temp_result["str"], []).append(j+1)
+    return programs
+
+# itereate through the problem archives in the zip folder
+def call_dolos(i, result):
     start = time.time()
-    program_index = folder_name[len("problem_"):-len("_zipped")]
+    program_index = str(i+1)
+    zip_path = os.path.join(ZIP_DIR, f"problem_{program_index}_zipped.zip")
+    print("working on archive: ", zip_path)
+
+    gold_program = result['test_str']
+    programs = unique_programs(result)
+
+    # dolos runs once for the whole problem and writes the similarity of every pair of files to its csv report,
+    # run directly, without going through a shell
+    # there is nothing to compare when every result is a copy of the gold program
+    scores = {}
+    if any(program != gold_program for program in programs):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_dir = os.path.join(tmp_dir, "report")
+            process = subprocess.run(
+                ["dolos", "run", "-f", "csv", "-o", report_dir, "--language", "python", zip_path],
+                stdout=subprocess.DEVNULL
+            )
+
+            # a failed run only loses the results of its own problem
+            try:
+                if process.returncode != 0:
+                    raise RuntimeError(f"dolos exited with code {process.returncode}")
+                with open(os.path.join(report_dir, "pairs.csv"), newline="") as f:
+                    pairs = list(csv.DictReader(f))
+            except (RuntimeError, OSError) as e:
+                print("dolos failed on ", zip_path, ": ", e)
+                return (program_index, [], time.time() - start)
+
+        # we only need the pairs with the gold program, the order of the result is stored in the other file's title
+        for pair in pairs:
+            file_names = {os.path.basename(pair["leftFilePath"]), os.path.basename(pair["rightFilePath"])}
+            if "gold_program" in file_names:
+                file_names.discard("gold_program")
+                index = int(file_names.pop()[len("high_score_"):])
+                scores[index] = float(pair["similarity"])
+
+    # copies of the gold program score 1 without being compared, the other copies share the score of the first one,
+    # programs that share nothing with the gold program don't show up in the report
     program_results = []
-    
-    folder_path = os.path.join(ZIP_DIR, folder_name)
-    
-    for file in os.listdir(folder_path):
-        # the order of the result is stored in the file's title
-        index = int(file[len("high_score_number_"):-len("_zipped.zip")])
-        
-        file_path = os.path.join(folder_path, file)
-        stream = os.popen(f"dolos run -f terminal --language python {file_path}")
-        output = stream.read()
-        output = output.split("\n")
-
-        for line in output:
-            if "Similarity score:" in line:
-                score = float(line[len("Similarity score: "):])
-                break
-        
-        program_results.append({"high_score_number": index, "score": score})
-
-    sorted_program_results = sorted(program_results, key=lambda d: d["score"], reverse = True)
+    for program, numbers in programs.items():
+        score = 1.0 if program == gold_program else scores.get(numbers[0], 0.0)
+        program_results.extend({"high_score_number": number, "score": score} for number in numbers)
+
+    sorted_program_results = heapq.nlargest(TOP_K, program_results, key=itemgetter("score"))
 
     end = time.time()
     run_time = end-start
@@ -47,7 +83,7 @@ def call_dolos(folder_name):
         "time": run_time
     }
 
-    print("folder name: ", folder_name, "finished in ", run_time, " seconds with n = ", len(sorted_program_results), " results")
+    print("archive name: ", zip_path, "finished in ", run_time, " seconds with n = ", len(sorted_program_results), " results")
 
     # outputs the results to a file in the results folder
     output_path = "dolos_results"
@@ -62,89 +98,77 @@ def call_dolos(folder_name):
 
     return (program_index, sorted_program_results, run_time)
 
-def zip_files():
-    with open(TEST_FILE, "r") as f:
-        results = [json.loads(s) for s in f.readlines()]
-
-    # we begin by making sure the output folders for the individual programs and dolos zipped files exist
+def zip_problem(i, result):
+    start = time.time()
+    gold_program = result['test_str']   # since the gold program isn't stored in the file, we take it from the original dataset
+
+    # one archive per problem for Dolos, holding the gold program and the top TOP_K results
+    # the programs are written straight into the archive, without plain copies on disk
+    # only the first copy of every program is stored, and copies of the gold program are left out altogether
+    # the archive is only a local handoff to dolos, so it is stored without compression
+    start_index = i+1
+    output_filename = os.path.join(ZIP_DIR, f"problem_{start_index}_zipped.zip")
     try:
-        os.mkdir(PLAIN_DIR)
+        with zipfile.ZipFile(output_filename, "w", zipfile.ZIP_STORED) as z:
+            z.writestr("gold_program", gold_program)
+            for program, numbers in unique_programs(result).items():
+                if program != gold_program:
+                    z.writestr(f"high_score_{numbers[0]}", program)
     except:
-        print(f"{PLAIN_DIR} already exists")
-        
+        print("problem when writing to ", output_filename, ".")
+
+    end = time.time()
+    print("time taken: ", end - start)
+
+def load_results():
+    # the parsed results are cached next to the results file, keyed by its size and modification time,
+    # so repeated runs on the same results skip the json parsing
+    # the cache is only a shortcut, when it can't be read or written the results file is simply parsed
+    stat = os.stat(TEST_FILE)
+    key = (stat.st_size, stat.st_mtime_ns)
+    try:
+        with open(TEST_FILE + ".pkl", "rb") as f:
+            cached_key, results = pickle.load(f)
+        if cached_key == key:
+            return results
+    except Exception:
+        pass
+
+    with open(TEST_FILE, "rb") as f:
+        results = [json.loads(s) for s in f]
+
+    # written to a temporary file first, so an interrupted run never leaves a truncated cache behind
+    try:
+        with open(TEST_FILE + ".pkl.tmp", "wb") as f:
+            pickle.dump((key, results), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(TEST_FILE + ".pkl.tmp", TEST_FILE + ".pkl")
+    except OSError as e:
+        print("could not cache the results: ", e)
+    return results
+
+def zip_files():
+    results = load_results()
+
+    # we begin by making sure the output folder for the dolos zipped files exists
     try:
         os.mkdir(ZIP_DIR)
     except:
         print(f"{ZIP_DIR} already exists")
-        
-        
-    # now we create the zipped files
-    for i, result in enumerate(results):
-        start = time.time()    
-        gold_program = results[i]['test_str']   # since the gold program isn't stored in the file, we take it from the original dataset
-        
-        # make a folder to store the results in:
-        start_index = i+1
-        directory = f"Copyright_test_{start_index}"
-        path = os.path.join(PLAIN_DIR, directory)
-        try:
-            os.mkdir(path)
-        except:
-            print("folder ", path, " already exists")
-
-        # makes folder for zip files for Dolos
-        directory = f"problem_{start_index}_zipped"    
-        zip_path = os.path.join(ZIP_DIR, directory)
-        try:
-            os.mkdir(zip_path)
-        except:
-            print("folder ", zip_path, " already exists")
-        
-
-        for j, temp_result in enumerate(result['top_k']):
-            # we only take the top 500 results
-            if j >= 500:
-                break
-
-            # makes a folder for the gold program and subsring # num
-            num_path = os.path.join(path, f"high_score_{j+1}")
-            try:
-                os.mkdir(num_path)
-            except:
-                print("folder ", num_path, " already exists")
 
-            # writes the substring to the output path
-            substring = temp_result["str"]
-            output_path = os.path.join(num_path, f"high_score_{j+1}")
-            try:
-                with open(output_path, "w") as f:
-                    f.write(substring)
-            except:
-                print("problem when writing to ", output_path, ".")
-
-            # writes the gold program to the output path
-            output_path = os.path.join(num_path, "gold_program")
-            try:
-                with open(output_path, "w") as f:
-                    f.write(gold_program)
-            except:
-                print("problem writing gold program")        
+    # now we create the zipped files, the problems are independent so they are zipped in parallel
+    with Pool(PROCESS_NUM) as p:
+        p.starmap(zip_problem, enumerate(results))
 
-            output_filename = os.path.join(zip_path, f"high_score_number_{j+1}_zipped")
-            shutil.make_archive(output_filename, 'zip', num_path)
-        
-        end = time.time()
-        print("time taken: ", end - start)
+    return results
 
 def main():
 
     # Dolos requires the input to be in a specific format, so we need to create zipped files for each question
-    zip_files()
+    results = zip_files()
 
-    folder_names = os.listdir(ZIP_DIR)
-
-    with Pool(PROCESS_NUM) as p:
-        results = p.map(call_dolos, folder_names)
+    # the work is done by the dolos processes, so threads are enough to keep PROCESS_NUM of them running
+    with ThreadPoolExecutor(PROCESS_NUM) as p:
+        results = list(p.map(call_dolos, range(len(results)), results))
         print(results)
 
 if __name__ == "__main__":
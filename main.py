@@ -1,122 +1,319 @@
 import os
 import json
+import heapq
+import hashlib
 import logging
 import time
+from collections import OrderedDict
 
-from multiprocessing import shared_memory, Pool
-from io import StringIO
-from thefuzz import fuzz
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.json as pa_json
+from rapidfuzz import fuzz, process
 from tqdm import tqdm
 
 CORPUS_DIR = "Github_Split"
 CORPUS_FILES = [os.path.join(CORPUS_DIR, f"The_Pile_Github_Split_{i}.jsonl") for i in range(30)]
+JSON_BLOCK_SIZE = 1 << 26  # bytes parsed at once by arrow, a document can't be longer than this
 
 TEST_FILE = "HumanEval.jsonl"
+RESULT_FILE = "human_eval_pile.jsonl"
+TOP_K = 500  # matches kept per test program
+THRESHOLD = 50  # lowest fuzz.ratio score reported as a match
+COARSE_STEP = 3  # windows skipped by the first pass of the scan, the second pass only covers promising regions
 
 
 # some parameters for parallelization
-CHUNK_SIZE = 2_000_000  # by character
+CHUNK_SIZE = 262_144  # by utf-8 byte, small enough for the windows of a chunk to stay in cache
 PROCESS_NUM = 16
+BATCH_CHUNKS = 512  # chunks handed to the workers at once, bounds the corpus held in memory
+CHUNK_CACHE_SIZE = 4096  # matched chunks remembered by digest, so repeated chunks aren't matched again
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
 
-def find_for_program(test_str: str, shm_name: str = "human_eval_pile", threshold: int = 50, stride_percent: float = 0.05):
-    # attach to the shared memory and decode it
-    existing_shm = shared_memory.SharedMemory(name=shm_name)
-    chunk_str = existing_shm.buf[:].tobytes().decode("utf-8")
-
-    # compute the scores
-    scores = []
-    stride = max(int(len(test_str) * stride_percent), 1)
-    for i in range(0, len(chunk_str) - len(test_str), stride):
-        score = fuzz.ratio(chunk_str[i:i+len(test_str)], test_str)
-        scores.append(score)
-    
-    # we need to find the indices of the "peaks"
-    peak_indices = []
-    for i in range(len(scores)):
-        if i == 0:
-            if scores[i] > scores[i+1]:
-                peak_indices.append((i, scores[i]))
-            continue
-
-        if i == len(scores) - 1:
-            if scores[i] > scores[i-1]:
-                peak_indices.append((i, scores[i]))
-            continue
-
-        if scores[i] >= scores[i-1] and scores[i] > scores[i+1]:
-            peak_indices.append((i, scores[i]))
-    
+# set by main before the pool is forked, the workers inherit them copy-on-write
+corpus_chunks = []
+test_programs = []
+
+def find_peaks(scores, stride: int, threshold: int):
+    # a window is a "peak" when it scores at least as high as the window before it and higher than the one after it,
+    # the comparisons are done on the whole score vector at once
+    scores = np.asarray(scores)
+    if len(scores) == 0:
+        return []
+
+    rises = np.ones(len(scores), dtype=bool)
+    rises[1:] = scores[1:] >= scores[:-1]
+    falls = np.ones(len(scores), dtype=bool)
+    falls[:-1] = scores[:-1] > scores[1:]
+    if len(scores) > 1:
+        rises[-1] = scores[-1] > scores[-2]
+
     # filter out the peaks that are below the threshold
-    peak_indices = [peak for peak in peak_indices if peak[1] >= threshold]
+    peak_indices = np.flatnonzero(rises & falls & (scores >= threshold))
+
+    # report the peaks as byte offsets into the chunk, same as the exact matches
+    return [(int(i) * stride, int(scores[i])) for i in peak_indices]
+
+
+def score_windows(queries: list, chunk_bytes: bytes, stride: int, threshold: int):
+    # scores every query against the windows starting every `stride` bytes of the chunk, windows that can't reach
+    # the threshold are left at 0, which can't create or remove a peak above the threshold
+    # the cutoff is applied before the scores are rounded, so it sits half a point under the threshold
+    # uint8 keeps the integer scores of fuzz.ratio and a quarter of the float32 memory
+    length = len(queries[0])
+    starts = np.arange(0, len(chunk_bytes) - length, stride)
+    scores = np.zeros((len(queries), len(starts)), dtype=np.uint8)
+    if len(starts) == 0:
+        return scores
+
+    # coarse pass over every COARSE_STEP-th window (and the last one). shifting a window by d bytes changes its
+    # ratio by at most 100 * d / length, so any window reaching the threshold is within reach of a coarse window
+    # scoring at least threshold - margin (one extra point covers rounding)
+    reach = COARSE_STEP // 2
+    margin = 100 * reach * stride / length + 1
+    coarse = np.unique(np.append(np.arange(0, len(starts), COARSE_STEP), len(starts) - 1))
+    coarse_scores = process.cdist(
+        queries, [chunk_bytes[i:i+length] for i in starts[coarse]],
+        scorer=fuzz.ratio, dtype=np.uint8, workers=1, score_cutoff=max(threshold - margin, 0)
+    )
+    candidates = coarse[(coarse_scores >= threshold - margin).any(axis=0)]
+
+    # fine pass around the candidates, one window further on each side so the neighbours of every peak are scored
+    fine = np.zeros(len(starts), dtype=bool)
+    for shift in range(-reach - 1, reach + 2):
+        fine[np.clip(candidates + shift, 0, len(starts) - 1)] = True
+    fine = np.flatnonzero(fine)
+    if len(fine):
+        scores[:, fine] = process.cdist(
+            queries, [chunk_bytes[i:i+length] for i in starts[fine]],
+            scorer=fuzz.ratio, dtype=np.uint8, workers=1, score_cutoff=threshold - 0.5
+        )
+    return scores
+
+
+def find_for_programs(chunk_index: int, test_group: list, threshold: int = THRESHOLD, stride_percent: float = 0.05):
+    # the chunk and the test programs are compared as utf-8 bytes
+    # all test programs of the group have the same length, so they share the windows of the chunk
+    chunk_bytes = corpus_chunks[chunk_index]
+    group_bytes = [test_programs[test_index] for test_index in test_group]
+    length = len(group_bytes[0])
+
+    # verbatim copies are found with a plain substring search and reported at their exact offset with a score of 100,
+    # the windows are still scanned so the near copies elsewhere in the chunk are kept as well
+    stride = max(int(length * stride_percent), 1)
+    scores = score_windows(group_bytes, chunk_bytes, stride, threshold)
+
+    group_peaks = []
+    for test_bytes, row in zip(group_bytes, scores):
+        exact_offsets = []
+        offset = chunk_bytes.find(test_bytes)
+        while offset != -1:
+            exact_offsets.append(offset)
+            offset = chunk_bytes.find(test_bytes, offset + 1)
+
+        # a window peak up to a stride away from an exact copy is that same copy seen off its alignment,
+        # the last window start can sit a full stride before a copy at the very end of the chunk
+        peaks = [(offset, 100) for offset in exact_offsets]
+        peaks += [peak for peak in find_peaks(row, stride, threshold) if all(abs(peak[0] - offset) > stride for offset in exact_offsets)]
+        group_peaks.append(sorted(peaks))
+    return group_peaks
+
+
+def find_for_task(task):
+    return find_for_programs(*task)
+
+
+def read_corpus_texts(corpus_file):
+    # parse the memory-mapped corpus file with arrow's multi-threaded json reader, only the text field is materialized
+    # the texts are yielded as the utf-8 bytes arrow already holds, so they never go through a python str
+    # documents without a text are skipped
+    rows_read = 0
+    try:
+        with pa.memory_map(corpus_file) as source:
+            reader = pa_json.open_json(
+                source,
+                read_options=pa_json.ReadOptions(block_size=JSON_BLOCK_SIZE),
+                parse_options=pa_json.ParseOptions(
+                    explicit_schema=pa.schema([("text", pa.large_string())]),
+                    unexpected_field_behavior="ignore",
+                ),
+            )
+            for batch in reader:
+                texts = batch.column(0).cast(pa.large_binary()).to_pylist()
+                rows_read += len(texts)
+                yield from (text for text in texts if text is not None)
+        return
+    except pa.ArrowInvalid as e:
+        # arrow can't parse a document longer than its block size, the rest of the file is read line by line instead
+        logger.warning(f"Falling back to json.loads for {corpus_file} after {rows_read} documents: {e}")
+
+    with open(corpus_file, "rb") as f:
+        lines = (line for line in f if line.strip())
+        for _ in range(rows_read):
+            next(lines)
+        for line in lines:
+            text = json.loads(line).get("text")
+            if text is not None:
+                yield text.encode("utf-8")
 
-    return peak_indices
+
+def read_corpus_batches(corpus_files, max_chunks=None):
+    # the chunks are kept as utf-8 bytes, which is what the workers compare against
+    # they are yielded in batches of BATCH_CHUNKS, so the whole corpus is never held in memory
+    # the texts of a chunk are collected in a list and joined once, so every byte is only copied once
+    # reading stops after max_chunks chunks when it is set
+    batch = []
+    chunk_texts = []
+    chunk_size = 0
+    chunk_count = 0
+    for corpus_file in tqdm(corpus_files):
+        for text in read_corpus_texts(corpus_file):
+            chunk_texts.append(text)
+            chunk_size += len(text)
+            if chunk_size >= CHUNK_SIZE:
+                batch.append(b"".join(chunk_texts))
+                chunk_texts = []
+                chunk_size = 0
+                chunk_count += 1
+                if chunk_count == max_chunks:
+                    yield batch
+                    return
+                if len(batch) == BATCH_CHUNKS:
+                    yield batch
+                    batch = []
+
+    if chunk_texts:
+        batch.append(b"".join(chunk_texts))
+    if batch:
+        yield batch
+
+
+def save_results(test_data, test_indices, top_k):
+    # the matches are ordered highest to lowest, in the format read by dolosmain.py
+    records = [None] * len(test_data)
+    for test_index, matches in zip(test_indices, top_k):
+        records[test_index] = {
+            "task_id": test_data[test_index].get("task_id"),
+            "test_str": test_data[test_index]["canonical_solution"],
+            "top_k": [{"str": match.decode("utf-8", errors="replace"), "score": score} for score, match in sorted(matches, reverse=True)],
+        }
+
+    # all records are serialized into one buffer and written with a single call,
+    # the file is replaced atomically so an interrupted run always leaves the last complete checkpoint behind
+    with open(RESULT_FILE + ".tmp", "w") as f:
+        f.write("".join(json.dumps(record) + "\n" for record in records))
+    os.replace(RESULT_FILE + ".tmp", RESULT_FILE)
 
 
 def main():
+    global corpus_chunks, test_programs
+
     # load the test file
     logger.info("Reading test file...")
-    with open(TEST_FILE, "r") as f:
-        test_data = [json.loads(line) for line in f.readlines()]
+    with open(TEST_FILE, "rb") as f:
+        test_data = [json.loads(line) for line in f]
     test_strs = [ex["canonical_solution"] for ex in test_data]
 
-    # load the corpus files
-    logger.info("Reading training corpus...")
-    corpus_data = []
-    for corpus_file in tqdm(CORPUS_FILES[:1]):  # FIXME: debug
-        with open(corpus_file, "r") as f:
-            corpus_data.extend([json.loads(line) for line in f.readlines()])
-    
-    # create the chunks first
-    chunk_strs = []
-    i = 0
-    while True:
-        str_builder = StringIO()
-        while i < len(corpus_data) and str_builder.tell() < CHUNK_SIZE:
-            str_builder.write(corpus_data[i]["text"])
-            i += 1
-
-        chunk_strs.append(str_builder.getvalue())        
-        if i == len(corpus_data):
-            break
-    logger.info(f"Created {len(chunk_strs)} chunks")
+    # longest test programs first, so the slowest tasks don't end up at the tail of the pool
+    test_idx_strs = sorted(enumerate(test_strs), key=lambda x: len(x[1]), reverse=True)
+    test_indices, test_strs = zip(*test_idx_strs)
+    test_programs = [test_str.encode("utf-8") for test_str in test_strs]
+
+    # test programs of the same length share their windows, so they are scored together
+    test_groups = {}
+    for test_index, test_bytes in enumerate(test_programs):
+        test_groups.setdefault(len(test_bytes), []).append(test_index)
+    test_groups = list(test_groups.values())
 
     # sequential for corpus data and parallel for test program
-    for chunk_str in tqdm(chunk_strs[:1]):  # FIXME: debug
-        start = time.perf_counter()
-
-        # create the shared memory and load data into it
-        chunk_str_bytes = chunk_str.encode("utf-8")
-        shm = shared_memory.SharedMemory(name="human_eval_pile", create=True, size=len(chunk_str_bytes))
-        shm.buf[:len(chunk_str_bytes)] = chunk_str_bytes
-
-        stop_1 = time.perf_counter()
-        logger.debug(f"Created shared memory in {(stop_1 - start) * 1000} ms, starting parallel processes...")
-
-        # create the processes, parallize for different test programs
-        test_idx_strs = sorted(enumerate(test_strs), key=lambda x: len(x[1]), reverse=True)
-        test_indices, test_strs = zip(*test_idx_strs)
-
-        with Pool(PROCESS_NUM) as pool:
-            results = pool.map(find_for_program, test_strs)
-        
-        # results = []
-        # intervals = []
-        # for test_str in tqdm(test_strs):
-        #     stop_3 = time.perf_counter()
-        #     results.append(find_for_program(test_str))
-        #     stop_4 = time.perf_counter()
-        #     intervals.append(stop_4 - stop_3)
-        
-        # print(f"Intervals: {sorted(intervals, reverse=True)}")
-        
-        shm.close()
-        shm.unlink()
-        
-        stop_2 = time.perf_counter()
-        logger.debug(f"Finished parallel processes in {stop_2 - stop_1} seconds")
+    # the next batch of chunks is read in a background thread while the current one is being matched
+    # identical chunks (e.g. files repeated across the corpus) are only matched once, keyed by their digest,
+    # the cache only keeps chunks with matches and drops the least recently seen one once it is full
+    logger.info("Reading training corpus...")
+    batches = read_corpus_batches(CORPUS_FILES[:1], max_chunks=1)  # FIXME: debug, only the first chunk of the corpus is scored
+    chunk_results = OrderedDict()  # digest -> {test index: peaks}, only the test programs with peaks
+    top_k = [[] for _ in test_programs]  # min-heaps of (score, matched bytes)
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        next_batch = loader.submit(next, batches, None)
+        while (corpus_chunks := next_batch.result()) is not None:
+            logger.info(f"Created {len(corpus_chunks)} chunks")
+
+            # the pool is forked after the batch is built and before the next read starts,
+            # so the workers read the chunks without any copy and the pool is shared by the whole batch
+            context = multiprocessing.get_context("fork")
+            with context.Pool(PROCESS_NUM) as pool:
+                next_batch = loader.submit(next, batches, None)
+
+                start = time.perf_counter()
+                chunk_indices = range(len(corpus_chunks))
+
+                # chunks already matched, earlier in this batch or in an earlier one, are skipped
+                digests = [hashlib.blake2b(corpus_chunks[chunk_index], digest_size=16).digest() for chunk_index in chunk_indices]
+                batch_results = {}
+                new_chunks = {}
+                for chunk_index, digest in zip(chunk_indices, digests):
+                    if digest in chunk_results:
+                        chunk_results.move_to_end(digest)
+                        batch_results[digest] = chunk_results[digest]
+                    else:
+                        new_chunks.setdefault(digest, chunk_index)
+
+                # test programs already holding TOP_K perfect matches can't improve, so they are no longer scanned
+                active_groups = [
+                    [test_index for test_index in test_group if len(top_k[test_index]) < TOP_K or top_k[test_index][0][0] < 100]
+                    for test_group in test_groups
+                ]
+                active_groups = [test_group for test_group in active_groups if test_group]
+
+                # once a test program holds TOP_K matches, no window scoring under its weakest one can get in,
+                # so that score is used as the cutoff of the scorer
+                thresholds = [
+                    min(top_k[test_index][0][0] if len(top_k[test_index]) == TOP_K else THRESHOLD for test_index in test_group)
+                    for test_group in active_groups
+                ]
+
+                # every (chunk, group) pair of the batch is handed to the pool at once, so the workers never wait
+                # for the slowest group of a chunk before starting on the next one
+                tasks = [
+                    (chunk_index, test_group, threshold)
+                    for chunk_index in new_chunks.values()
+                    for test_group, threshold in zip(active_groups, thresholds)
+                ]
+                # tasks are handed out a few at a time, so the expensive groups are spread over the workers
+                group_peaks = iter(tqdm(pool.imap(find_for_task, tasks, chunksize=4), total=len(tasks)))
+                for digest in new_chunks:
+                    results = {}
+                    for test_group in active_groups:
+                        for test_index, test_peaks in zip(test_group, next(group_peaks)):
+                            if test_peaks:
+                                results[test_index] = test_peaks
+                    batch_results[digest] = results
+                    if results:
+                        chunk_results[digest] = results
+                        if len(chunk_results) > CHUNK_CACHE_SIZE:
+                            chunk_results.popitem(last=False)
+
+                # keep the TOP_K best matches of every test program
+                for chunk_index, digest in zip(chunk_indices, digests):
+                    for test_index, peaks in batch_results[digest].items():
+                        length = len(test_programs[test_index])
+                        for offset, score in peaks:
+                            match = (int(score), corpus_chunks[chunk_index][offset:offset+length])
+                            if len(top_k[test_index]) < TOP_K:
+                                heapq.heappush(top_k[test_index], match)
+                            else:
+                                heapq.heappushpop(top_k[test_index], match)
+
+                stop = time.perf_counter()
+                logger.debug(f"Finished parallel processes in {stop - start} seconds")
+
+            # checkpoint the results after every batch, so a crash only loses the batch in progress
+            logger.info(f"Saving results to {RESULT_FILE}...")
+            save_results(test_data, test_indices, top_k)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()